@@ -1,233 +1,697 @@
+import asyncio
+import functools
+import hashlib
 import json
+import logging
+import os
 import subprocess
+import time
 import re
 import csv
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # orjson decodes the large `solana` JSON outputs several times faster
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    from icmplib import async_ping
+    from icmplib.exceptions import ICMPLibError, SocketPermissionError
+except ImportError:
+    async_ping = None
 
 # --- Configuration ---
 OUTPUT_FILE = 'dz_latency_result.csv'
+# CSV columns; City and Country are left empty when geolocation is disabled.
+# Method records which probe ('tcp' or 'icmp') measured the latency.
+FIELDS = ['IP', 'Status', 'Validator Name', 'Latency', 'City', 'Country', 'Method']
 DZ_INTERFACE = 'doublezero0'
-
-def ping_ip(ip_address):
+PING_WORKERS = 64  # Upper bound on concurrent pings (icmplib sockets or ping processes)
+GEO_WORKERS = 2    # Upper bound on concurrent ip-api.com batch requests (limited to 15 per minute)
+GEO_BATCH_SIZE = 100  # Maximum number of IPs per ip-api.com batch request
+PING_REPLY_TIMEOUT = 1  # Seconds to wait for an echo reply, on both the icmplib and ping command paths
+# Adaptive ping (-A) sends the next probe as soon as a reply arrives and the
+# deadline (-w) bounds the whole run; -n skips reverse DNS. The IP is appended.
+PING_COMMAND = ('ping', '-n', '-c', '3', '-A', '-w', str(PING_REPLY_TIMEOUT), '-W', str(PING_REPLY_TIMEOUT))
+PING_TIMEOUT = 3  # Seconds before a ping process is killed
+UNREACHABLE = 'unreachable'  # Latency reported for IPs that did not answer
+# Average RTT from the summary line of `ping`, compiled once for all pings
+LATENCY_PATTERN = re.compile(r"min/avg/max/mdev = [\d.]+/([\d.]+)/")
+TCP_PROBE_PORT = 8001  # Solana gossip port, which also accepts TCP connections
+TCP_PROBE_TIMEOUT = 0.5
+TCP_PROBE_WORKERS = 128  # Upper bound on concurrent TCP probes, each holding one socket
+CACHE_DIR = os.path.expanduser('~/.cache/dz_latency')
+SOLANA_CONFIG_FILE = os.path.expanduser('~/.config/solana/cli/config.yml')
+SOLANA_DEFAULT_URL = 'https://api.mainnet-beta.solana.com'  # Used by the CLI when no URL is configured
+GOSSIP_CACHE_TTL = 60           # Seconds before cached `solana gossip` output is refreshed
+VALIDATORS_CACHE_TTL = 60       # Seconds before cached `solana validators` output is refreshed
+VALIDATOR_INFO_CACHE_TTL = 300  # Seconds before cached `solana validator-info` output is refreshed
+
+log = logging.getLogger(__name__)
+
+# Shared HTTP session so geolocation requests reuse pooled keep-alive connections.
+# ip-api.com lookups are idempotent, so POSTs to the batch endpoint are retried too.
+# Rate limiting (429) is handled in `get_ip_locations`, which waits for the window to reset.
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(
+    pool_connections=GEO_WORKERS, pool_maxsize=GEO_WORKERS,
+    max_retries=Retry(total=2, backoff_factor=0.2, allowed_methods=frozenset({"GET", "POST"}))))
+# Monotonic time before which no geolocation batch may be sent (rate limit window reset)
+geo_resume_at = 0.0
+# Set when the run is interrupted so lookups waiting on the rate limit give up
+geo_stop = threading.Event()
+# icmplib socket modes still worth trying: raw sockets (privileged=True) need root
+# or CAP_NET_RAW, datagram sockets (privileged=False) need the user's group in
+# net.ipv4.ping_group_range. A mode is dropped once it is refused.
+icmplib_modes = [True, False] if async_ping is not None else []
+
+async def run_ping_command(ip_address, semaphore):
     """
-    Pings an IP address to get its latency. Handles different OS commands.
+    Pings an IP address with the system ping command to get its latency.
 
     Args:
         ip_address (str): The IP address to ping.
+        semaphore (asyncio.Semaphore): Limits the number of concurrent ping processes.
 
     Returns:
         str: The latency in ms, or 'unreachable' if the ping fails.
     """
     try:
-        command = ['ping', '-c', '3', '-i', '0.2', '-W', '0.5', ip_address]
-        latency_pattern = r"min/avg/max/mdev = [\d.]+/([\d.]+)/[\d.]+/[\d.]+ ms"
-
-        # Execute the ping command
-        result = subprocess.run(command, capture_output=True, text=True, timeout=5)
-
-        if result.returncode == 0:
-            # Search for the latency in the output
-            match = re.search(latency_pattern, result.stdout)
-            if match:
-                latency = match.group(1)
-                print(f"Ping successful for {ip_address}: {latency} ms")
+        async with semaphore:
+            # Execute the ping command
+            process = await asyncio.create_subprocess_exec(
+                *PING_COMMAND, ip_address,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            try:
+                stdout, _ = await asyncio.wait_for(process.communicate(), timeout=PING_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                # Do not leave ping running after a timeout or an interrupted run
+                process.kill()
+                await process.wait()
+                raise
+
+        # ping exits non-zero when the deadline expires before all probes are
+        # answered, but still prints the summary if any reply was received
+        match = LATENCY_PATTERN.search(stdout.decode())
+        if match:
+            latency = match.group(1)
+            log.debug("Ping successful for %s: %s ms", ip_address, latency)
+            return latency
+
+        log.debug("Ping failed for %s.", ip_address)
+        return UNREACHABLE
+
+    except asyncio.TimeoutError:
+        log.debug("Ping timed out for %s.", ip_address)
+        return UNREACHABLE
+    except Exception as e:
+        log.warning("An error occurred during ping for %s: %s", ip_address, e)
+        return UNREACHABLE
+
+
+async def ping_ip(ip_address, semaphore):
+    """
+    Pings an IP address to get its latency.
+
+    Uses icmplib, which pings without spawning a process, when it is installed
+    and the process may open a raw ICMP socket (root or CAP_NET_RAW) or an
+    unprivileged ICMP datagram socket. Otherwise falls back to the system ping
+    command.
+
+    Args:
+        ip_address (str): The IP address to ping.
+        semaphore (asyncio.Semaphore): Limits the number of concurrent pings.
+
+    Returns:
+        str: The latency in ms, or 'unreachable' if the ping fails.
+    """
+    while icmplib_modes:
+        privileged = icmplib_modes[0]
+        try:
+            # icmplib opens one socket per host, so it shares the ping limit
+            async with semaphore:
+                host = await async_ping(ip_address, count=3, interval=0.2,
+                                        timeout=PING_REPLY_TIMEOUT, privileged=privileged)
+        except SocketPermissionError as e:
+            # Another ping may already have dropped this mode
+            if icmplib_modes and icmplib_modes[0] is privileged:
+                icmplib_modes.pop(0)
+                if icmplib_modes:
+                    log.debug("Cannot open a raw ICMP socket (%s), trying an unprivileged one.", e)
+                else:
+                    log.warning("Cannot ping with icmplib (%s), falling back to the ping command.", e)
+            continue
+        except ICMPLibError as e:
+            log.debug("icmplib could not ping %s (%s), using the ping command.", ip_address, e)
+            break
+        else:
+            if host.is_alive:
+                latency = f"{host.avg_rtt:.3f}"
+                log.debug("Ping successful for %s: %s ms", ip_address, latency)
                 return latency
-        
-        print(f"Ping failed for {ip_address}.")
-        return 'unreachable'
+            log.debug("Ping failed for %s.", ip_address)
+            return UNREACHABLE
+
+    return await run_ping_command(ip_address, semaphore)
+
+
+async def tcp_rtt(ip_address, port, semaphore, timeout=TCP_PROBE_TIMEOUT):
+    """
+    Measures the TCP connect time to an IP address and port.
+
+    Args:
+        ip_address (str): The IP address to probe.
+        port (int): The TCP port to connect to.
+        semaphore (asyncio.Semaphore): Limits the number of concurrent probes.
+        timeout (float): Seconds to wait for each connection attempt.
+
+    Returns:
+        float or None: The average connect time in ms over 3 attempts, or None if none succeeded.
+    """
+    loop = asyncio.get_running_loop()
+    samples = []
+    # Only start timing once the probe holds a slot, so that waiting behind
+    # other probes is not counted as round-trip time
+    async with semaphore:
+        for _ in range(3):
+            start = loop.time()
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(ip_address, port), timeout)
+            except (OSError, asyncio.TimeoutError):
+                continue
+            samples.append((loop.time() - start) * 1000)
+            writer.close()
+    return sum(samples) / len(samples) if samples else None
+
+
+async def probe_ip(ip_address, probe, tcp_semaphore, ping_semaphore):
+    """
+    Measures the latency of an IP address with the selected probe.
+
+    TCP probes connect to the validator gossip port. If the IP does not accept
+    the connection it is pinged over ICMP instead.
+
+    Args:
+        ip_address (str): The IP address to probe.
+        probe (str): Either 'tcp' or 'icmp'.
+        tcp_semaphore (asyncio.Semaphore): Limits the number of concurrent TCP probes.
+        ping_semaphore (asyncio.Semaphore): Limits the number of concurrent pings.
+
+    Returns:
+        tuple: A tuple containing (IP address, latency in ms or 'unreachable', method),
+        where method is the probe that measured the latency.
+    """
+    if probe == 'tcp':
+        rtt = await tcp_rtt(ip_address, TCP_PROBE_PORT, tcp_semaphore)
+        if rtt is not None:
+            log.debug("TCP probe successful for %s: %.3f ms", ip_address, rtt)
+            return ip_address, f"{rtt:.3f}", 'tcp'
+        log.debug("%s did not accept TCP on port %s, pinging it instead.", ip_address, TCP_PROBE_PORT)
+
+    return ip_address, await ping_ip(ip_address, ping_semaphore), 'icmp'
+
+
+async def probe_all(ip_addresses, probe, on_result):
+    """
+    Runs `probe_ip` for all IP addresses concurrently, with at most
+    TCP_PROBE_WORKERS connections and PING_WORKERS pings in flight.
+
+    Args:
+        ip_addresses (list): The IP addresses to probe.
+        probe (str): Either 'tcp' or 'icmp'.
+        on_result (callable): Called with the result of `probe_ip` as each probe completes.
+    """
+    tcp_semaphore = asyncio.Semaphore(TCP_PROBE_WORKERS)
+    ping_semaphore = asyncio.Semaphore(PING_WORKERS)
+    probes = [probe_ip(ip, probe, tcp_semaphore, ping_semaphore) for ip in ip_addresses]
+    for next_result in asyncio.as_completed(probes):
+        on_result(*await next_result)
 
-    except subprocess.TimeoutExpired:
-        print(f"Ping timed out for {ip_address}.")
-        return 'unreachable'
-    except Exception as e:
-        print(f"An error occurred during ping for {ip_address}: {e}")
-        return 'unreachable'
+
+def measure_latencies(ip_addresses, probe, on_result):
+    """
+    Measures the latency of all IP addresses with the selected probe, reporting
+    each result as soon as it is available.
+
+    Args:
+        ip_addresses (list): The IP addresses to probe.
+        probe (str): Either 'tcp' or 'icmp'.
+        on_result (callable): Called as on_result(ip, latency, method) for each IP.
+    """
+    asyncio.run(probe_all(ip_addresses, probe, on_result))
 
 
 def get_ips_from_rt():
     """
-    Gets a list of IP addresses by running a shell command.
+    Gets a list of IP addresses from the host routes on the DoubleZero interface.
 
     Returns:
-        list: A list of IP addresses.
+        list: A list of unique IP addresses.
     """
-    command = "ip route show dev %s | awk '{print $1}'" % DZ_INTERFACE
-    print(f"Running command to get IPs: \"{command}\"")
+    command = ['ip', '-j', 'route', 'show', 'dev', DZ_INTERFACE]
+    log.info("Running command to get IPs: `%s`", ' '.join(command))
     try:
-        # Execute the shell command
-        result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=15)
+        # Execute the command; -j makes ip print the routes as JSON
+        result = subprocess.run(command, capture_output=True, timeout=15)
         if result.returncode != 0:
-            print(f"Error running command to get IPs: {result.stderr}")
+            log.error("Error running command to get IPs: %s", result.stderr.decode('utf-8', 'replace'))
             return []
 
-        # Process the output
-        ips = result.stdout.strip().split('\n')
-        # Filter out any empty strings
-        return [ip for ip in ips if ip]
+        # Older iproute2 versions print nothing rather than [] when there are no routes
+        if not result.stdout.strip():
+            return []
+
+        # Take the destination of each host route. Subnets and the default route
+        # cannot be pinged, and several routes may point at the same host.
+        ips = []
+        for route in json_loads(result.stdout):
+            address, _, prefix = route.get('dst', '').partition('/')
+            if address and address != 'default' and prefix in ('', '32', '128'):
+                ips.append(address)
+        return list(dict.fromkeys(ips))
 
     except subprocess.TimeoutExpired:
-        print("Error: Command to get IPs timed out.")
+        log.error("Command to get IPs timed out.")
+        return []
+    except json.JSONDecodeError:
+        log.error("Could not decode JSON from `ip route` command.")
         return []
     except Exception as e:
-        print(f"An unexpected error occurred while getting IPs: {e}")
+        log.error("An unexpected error occurred while getting IPs: %s", e)
         return []
 
-def load_gossip_data():
+@functools.lru_cache(maxsize=None)
+def get_cluster_url():
     """
-    Runs the 'solana gossip' command and loads the output as JSON.
+    Gets the RPC URL the `solana` CLI is configured to use by reading its
+    config file, which is much cheaper than running `solana config get`.
 
     Returns:
-        list or None: A list of gossip entries if successful, otherwise None.
+        str or None: The RPC URL, or None if it could not be determined.
     """
     try:
-        # Execute the solana gossip command
-        command = ['solana', 'gossip', '--output=json']
-        print(f"Running command to load gossip data: `{' '.join(command)}`")
-        result = subprocess.run(command, capture_output=True, text=True, timeout=30)
-        if result.returncode != 0:
-            print(f"Error running 'solana gossip': {result.stderr}")
-            return None
-
-        return json.loads(result.stdout)
+        with open(SOLANA_CONFIG_FILE, 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key.strip() == 'json_rpc_url':
+                    return value.strip().strip('\'"') or None
     except FileNotFoundError:
-        print("Error: 'solana' command not found. Make sure it's installed and in your PATH.")
+        # Without a config file the CLI talks to its default cluster
+        return SOLANA_DEFAULT_URL
+    except OSError as e:
+        log.warning("Could not read the solana CLI config, not caching its data: %s", e)
         return None
-    except subprocess.TimeoutExpired:
-        print("Error: 'solana gossip' command timed out.")
+    return SOLANA_DEFAULT_URL
+
+def cluster_cache_name(name):
+    """
+    Gets the cache entry name for data that depends on the configured cluster,
+    so that switching clusters never serves another cluster's cached data.
+
+    Args:
+        name (str): The cache entry name, without extension.
+
+    Returns:
+        str or None: The cluster-specific entry name, or None if the cluster is unknown
+        and the data must not be cached.
+    """
+    url = get_cluster_url()
+    if url is None:
         return None
-    except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from `solana gossip` command.")
+    return f"{name}-{hashlib.sha256(url.encode()).hexdigest()[:16]}"
+
+def read_cache(name, ttl=None):
+    """
+    Reads a JSON entry from the cache directory.
+
+    Args:
+        name (str or None): The cache entry name, without extension. None never matches.
+        ttl (int or None): Maximum age of the entry in seconds, or None for no limit.
+
+    Returns:
+        The cached data, or None if the entry is missing, expired or unreadable.
+    """
+    if name is None:
+        return None
+    path = os.path.join(CACHE_DIR, f'{name}.json')
+    try:
+        if ttl is not None and os.path.getmtime(path) < time.time() - ttl:
+            return None
+        with open(path, 'rb') as f:
+            return json_loads(f.read())
+    except (OSError, json.JSONDecodeError):
         return None
 
-def get_identity_from_gossip(ip_address, gossip_data):
+def write_cache(name, data):
     """
-    Runs the 'solana gossip' command and parses the output to find
-    the identity for a given IP address.
+    Writes a JSON entry to the cache directory, replacing any previous entry.
 
     Args:
-        ip_address (str): The IP address to check.
+        name (str or None): The cache entry name, without extension. None stores nothing.
+        data: The JSON-serializable data to store.
+    """
+    if name is None:
+        return
+    path = os.path.join(CACHE_DIR, f'{name}.json')
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first so readers never see a partial entry
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log.warning("Could not write cache file '%s': %s", path, e)
+
+@functools.lru_cache(maxsize=None)
+def load_gossip_data(refresh=False):
+    """
+    Runs the 'solana gossip' command and loads the output as JSON.
+    The output is cached on disk for GOSSIP_CACHE_TTL seconds.
+
+    Args:
+        refresh (bool): Ignore the disk cache and always run the command.
 
     Returns:
-        str or None: The identity public key if found, otherwise None.
+        list or None: A list of gossip entries if successful, otherwise None.
     """
+    cache_name = cluster_cache_name('gossip')
+    gossip_data = None if refresh else read_cache(cache_name, GOSSIP_CACHE_TTL)
+    if gossip_data is not None:
+        log.info("Loaded gossip data from cache.")
+        return gossip_data
+
     try:
-        # Iterate through the gossip data to find the matching IP
-        for entry in gossip_data:
-            if entry.get("ipAddress") == ip_address:
-                identity_pubkey = entry.get("identityPubkey")
-                if identity_pubkey:
-                    print(f"Found identity '{identity_pubkey}' for IP: {ip_address}")
-                    return identity_pubkey
-        
-        print(f"IP {ip_address} not found in gossip.")
+        # Execute the solana gossip command. Its output is kept as bytes and
+        # handed straight to the JSON parser, which avoids decoding it to str first.
+        command = ['solana', 'gossip', '--output=json']
+        log.info("Running command to load gossip data: `%s`", ' '.join(command))
+        result = subprocess.run(command, capture_output=True, timeout=30)
+        if result.returncode != 0:
+            log.error("Error running 'solana gossip': %s", result.stderr.decode('utf-8', 'replace'))
+            return None
+
+        gossip_data = json_loads(result.stdout)
+        write_cache(cache_name, gossip_data)
+        return gossip_data
+    except FileNotFoundError:
+        log.error("'solana' command not found. Make sure it's installed and in your PATH.")
         return None
-    except Exception as e: # Catch any other unexpected errors during data processing
+    except subprocess.TimeoutExpired:
+        log.error("'solana gossip' command timed out.")
         return None
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+    except json.JSONDecodeError:
+        log.error("Could not decode JSON from `solana gossip` command.")
         return None
 
-def load_active_validators():
+@functools.lru_cache(maxsize=None)
+def load_active_validators(refresh=False):
     """
     Loads the list of active validator identity pubkeys by running
-    the `solana validators` command.
+    the `solana validators` command. The command output is cached on disk
+    for VALIDATORS_CACHE_TTL seconds.
+
+    Args:
+        refresh (bool): Ignore the disk cache and always run the command.
 
     Returns:
         set: A set of active validator identity pubkeys for efficient lookup.
     """
     command = ['solana', 'validators', '--output=json']
-    print(f"Running command to get active validators: `{' '.join(command)}`")
+    cache_name = cluster_cache_name('validators')
     try:
-        result = subprocess.run(command, capture_output=True, text=True, timeout=60)
-        if result.returncode != 0:
-            print(f"Error running command to get active validators: {result.stderr}")
-            return set()
-        
-        data = json.loads(result.stdout)
+        data = None if refresh else read_cache(cache_name, VALIDATORS_CACHE_TTL)
+        if data is None:
+            log.info("Running command to get active validators: `%s`", ' '.join(command))
+            result = subprocess.run(command, capture_output=True, timeout=60)
+            if result.returncode != 0:
+                log.error("Error running command to get active validators: %s",
+                          result.stderr.decode('utf-8', 'replace'))
+                return set()
+
+            data = json_loads(result.stdout)
+            write_cache(cache_name, data)
+
         validator_list = data.get("validators", [])
-        active_identities = {v.get("identityPubkey") for v in validator_list if v.get("identityPubkey")}
-        print(f"Loaded {len(active_identities)} active validator identities.")
+        active_identities = set()
+        for v in validator_list:
+            identity_pubkey = v.get("identityPubkey")
+            if identity_pubkey:
+                active_identities.add(identity_pubkey)
+        log.info("Loaded %s active validator identities.", len(active_identities))
         return active_identities
     except FileNotFoundError:
-        print("Error: 'solana' command not found. Make sure it's installed and in your PATH.")
+        log.error("'solana' command not found. Make sure it's installed and in your PATH.")
         return set()
     except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from `solana validators` command.")
+        log.error("Could not decode JSON from `solana validators` command.")
         return set()
     except subprocess.TimeoutExpired:
-        print("Error: `solana validators` command timed out.")
+        log.error("`solana validators` command timed out.")
         return set()
     except Exception as e:
-        print(f"An unexpected error occurred while loading active validators: {e}")
+        log.error("An unexpected error occurred while loading active validators: %s", e)
         return set()
 
-def load_validator_details():
+@functools.lru_cache(maxsize=None)
+def load_validator_details(refresh=False):
     """
     Loads validator information by running the `solana validator-info get` command
-    and creates a mapping from identity public key to validator name.
+    and creates a mapping from identity public key to validator name. The command
+    output is cached on disk for VALIDATOR_INFO_CACHE_TTL seconds.
+
+    Args:
+        refresh (bool): Ignore the disk cache and always run the command.
 
     Returns:
         dict: A dictionary mapping identity pubkeys to validator names.
     """
     command = ['solana', 'validator-info', 'get', '--output=json']
-    print(f"Running command to get validator details: `{' '.join(command)}`")
+    cache_name = cluster_cache_name('validator_info')
     try:
-        result = subprocess.run(command, capture_output=True, text=True, timeout=60)
-        if result.returncode != 0:
-            print(f"Error running command to get validator details: {result.stderr}")
-            return {}
-
-        validators_data = json.loads(result.stdout)
-        validator_map = {
-            v.get("identityPubkey"): v.get("info", {}).get("name")
-            for v in validators_data
-            if v.get("identityPubkey") and v.get("info", {}).get("name")
-        }
-        print(f"Loaded {len(validator_map)} validator details.")
+        validators_data = None if refresh else read_cache(cache_name, VALIDATOR_INFO_CACHE_TTL)
+        if validators_data is None:
+            log.info("Running command to get validator details: `%s`", ' '.join(command))
+            result = subprocess.run(command, capture_output=True, timeout=60)
+            if result.returncode != 0:
+                log.error("Error running command to get validator details: %s",
+                          result.stderr.decode('utf-8', 'replace'))
+                return {}
+
+            validators_data = json_loads(result.stdout)
+            write_cache(cache_name, validators_data)
+
+        # Look up each field once rather than once to test and again to store
+        validator_map = {}
+        for v in validators_data:
+            identity_pubkey = v.get("identityPubkey")
+            if not identity_pubkey:
+                continue
+            info = v.get("info")
+            name = info.get("name") if info else None
+            if name:
+                validator_map[identity_pubkey] = name
+        log.info("Loaded %s validator details.", len(validator_map))
         return validator_map
     except FileNotFoundError:
-        print("Error: 'solana' command not found. Make sure it's installed and in your PATH.")
+        log.error("'solana' command not found. Make sure it's installed and in your PATH.")
         return {}
     except json.JSONDecodeError:
-        print(f"Error: Could not decode JSON from `solana validator-info` command.")
+        log.error("Could not decode JSON from `solana validator-info` command.")
         return {}
     except subprocess.TimeoutExpired:
-        print("Error: `solana validator-info` command timed out.")
+        log.error("`solana validator-info` command timed out.")
         return {}
     except Exception as e:
-        print(f"An unexpected error occurred while loading validator details: {e}")
+        log.error("An unexpected error occurred while loading validator details: %s", e)
         return {}
 
-def get_ip_location(ip_address):
+def get_header_int(headers, name):
     """
-    Fetches the city and country for a given IP address using ip-api.com.
+    Reads an integer HTTP response header.
 
     Args:
-        ip_address (str): The IP address to look up.
+        headers (Mapping): The response headers.
+        name (str): The header name.
 
     Returns:
-        tuple: A tuple containing (city, country) or ('Unknown', 'Unknown') if lookup fails.
+        int or None: The header value, or None if it is missing or malformed.
     """
     try:
-        response = requests.get(f"http://ip-api.com/json/{ip_address}", timeout=5)
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def get_ip_locations(ip_addresses):
+    """
+    Fetches the city and country for up to GEO_BATCH_SIZE IP addresses with a
+    single request to the ip-api.com batch endpoint.
+
+    Args:
+        ip_addresses (list): The IP addresses to look up.
+
+    Returns:
+        dict: A dictionary mapping each IP address to a (city, country) tuple, or
+        ('Unknown', 'Unknown') if its lookup fails.
+    """
+    global geo_resume_at
+
+    locations = {ip: ('Unknown', 'Unknown') for ip in ip_addresses}
+    try:
+        # ip-api.com reports the requests left in the current window (X-Rl) and the
+        # seconds until it resets (X-Ttl). A rate-limited batch is sent once more
+        # after the window resets.
+        for _ in range(2):
+            wait = geo_resume_at - time.monotonic()
+            if wait > 0:
+                log.info("ip-api.com rate limit reached, waiting %.0f seconds.", wait)
+                if geo_stop.wait(wait):
+                    return locations
+
+            response = SESSION.post("http://ip-api.com/batch",
+                                    params={"fields": "status,message,country,city,query"},
+                                    json=[{"query": ip} for ip in ip_addresses], timeout=10)
+            if response.status_code != 429:
+                break
+            geo_resume_at = time.monotonic() + (get_header_int(response.headers, "X-Ttl") or 60)
         response.raise_for_status()  # Raise an exception for HTTP errors
-        data = response.json()
 
-        if data.get("status") == "success":
-            city = data.get("city", "Unknown")
-            country = data.get("country", "Unknown")
-            print(f"Location for {ip_address}: {city}, {country}")
-            return city, country
-        else:
-            print(f"Could not get location for {ip_address}: {data.get('message', 'Unknown error')}")
-            return 'Unknown', 'Unknown'
+        # Hold back further batches until the reset when the remaining requests
+        # could not cover every worker
+        remaining = get_header_int(response.headers, "X-Rl")
+        if remaining is not None and remaining < GEO_WORKERS:
+            geo_resume_at = time.monotonic() + (get_header_int(response.headers, "X-Ttl") or 60)
+
+        # Results come back in request order. Pair them with the IPs that were
+        # sent, because the echoed "query" may be normalized (e.g. IPv6 case).
+        for ip_address, data in zip(ip_addresses, response.json()):
+            if data.get("status") == "success":
+                city = data.get("city", "Unknown")
+                country = data.get("country", "Unknown")
+                log.debug("Location for %s: %s, %s", ip_address, city, country)
+                locations[ip_address] = (city, country)
+            else:
+                log.warning("Could not get location for %s: %s", ip_address, data.get('message', 'Unknown error'))
     except requests.exceptions.RequestException as e:
-        print(f"Error fetching location for {ip_address}: {e}")
-        return 'Unknown', 'Unknown'
+        log.error("Error fetching locations for %s IPs: %s", len(ip_addresses), e)
     except Exception as e:
-        print(f"An unexpected error occurred during location lookup for {ip_address}: {e}")
-        return 'Unknown', 'Unknown'
+        log.error("An unexpected error occurred during location lookup for %s IPs: %s", len(ip_addresses), e)
+    return locations
+
+def get_validator_status(ip_address, gossip_by_ip, active_validator_identities, validator_info):
+    """
+    Determines whether an IP address belongs to an active validator.
+
+    Args:
+        ip_address (str): The IP address to check.
+        gossip_by_ip (dict): A dictionary mapping gossip IP addresses to identity pubkeys.
+        active_validator_identities (set): The identity pubkeys of active validators.
+        validator_info (dict): A dictionary mapping identity pubkeys to validator names.
+
+    Returns:
+        tuple: A tuple containing (status, validator name).
+    """
+    identity_key = gossip_by_ip.get(ip_address)
+    if not identity_key:
+        log.debug("IP %s not found in gossip.", ip_address)
+        return 'gossip_not_found', ''
+
+    log.debug("Found identity '%s' for IP: %s", identity_key, ip_address)
+    # Check if the found identity is in the set of active validators
+    if identity_key in active_validator_identities:
+        # Look up the validator name from the details map
+        name = validator_info.get(identity_key, "Unknown")
+        log.debug("IP %s with identity %s is an active validator named '%s'.",
+                  ip_address, identity_key, name)
+        return 'validator', name
+
+    log.debug("IP %s has an identity (%s) but is NOT in the active validator list.",
+              ip_address, identity_key)
+    return 'gossip', ''
+
+class ResultWriter:
+    """
+    Joins probe results with geolocation lookups and writes each CSV row once both are known.
+
+    Args:
+        f (file): The open output file.
+        get_status (callable): Maps an IP address to (status, validator name).
+        need_location (bool): Whether rows wait for a location before being written.
+        locations (dict): Locations already known, mapping IP addresses to (city, country).
+    """
+
+    def __init__(self, f, get_status, need_location=True, locations=None):
+        self.f = f
+        self.writer = csv.DictWriter(f, fieldnames=FIELDS)
+        self.get_status = get_status
+        self.need_location = need_location
+        self.latencies = {}
+        self.locations = dict(locations or {})
+        self.written = set()
+
+        self.writer.writeheader()
+        self.f.flush()
+
+    def add_latency(self, ip, latency, method):
+        """
+        Records the latency of an IP and writes its row if its location is known.
+
+        Args:
+            ip (str): The IP address.
+            latency (str): The average latency in ms or UNREACHABLE.
+            method (str): The probe that produced the latency.
+        """
+        self.latencies[ip] = (latency, method)
+        if not self.need_location or ip in self.locations:
+            self.write_row(ip)
+
+    def add_location(self, ip, city, country):
+        """
+        Records the location of an IP and writes its row if its latency is known.
+
+        Args:
+            ip (str): The IP address.
+            city (str): The city of the IP address.
+            country (str): The country of the IP address.
+        """
+        self.locations[ip] = (city, country)
+        if ip in self.latencies:
+            self.write_row(ip)
+
+    def write_row(self, ip):
+        """
+        Writes the CSV row of an IP, at most once.
+
+        Args:
+            ip (str): The IP address.
+        """
+        if ip in self.written:
+            return
+        self.written.add(ip)
+
+        status, name = self.get_status(ip)
+        latency, method = self.latencies[ip]
+        city, country = self.locations.get(ip, ('', ''))
+        # One summary line per IP; the per-step details are only logged with --verbose
+        log.info("%s: status=%s name='%s' latency=%s (%s)", ip, status, name, latency, method)
+        self.writer.writerow({
+            'IP': ip,
+            'Status': status,
+            'Validator Name': name.replace(',', ''),
+            'Latency': latency,
+            'City': city,
+            'Country': country,
+            'Method': method,
+        })
+        self.f.flush()
 
-import requests
 def main():
     """
     Main function to orchestrate the validator checking process.
@@ -237,77 +701,121 @@ def main():
     parser = argparse.ArgumentParser(description="Check validator status and latency.")
     parser.add_argument("--ip_list", help="Path to a file containing a list of IP addresses, one per line.")
     parser.add_argument("--no_geo", action="store_true", help="Enable geolocation lookup.")
+    parser.add_argument("--probe", choices=['tcp', 'icmp'], default='tcp',
+                        help="Measure latency with TCP connects to the gossip port (falling back to ICMP) or ICMP only.")
+    parser.add_argument("--only_validators", action="store_true",
+                        help="Only probe IPs that belong to active validators.")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Ignore cached solana CLI and geolocation data and fetch it again.")
+    parser.add_argument("--verbose", action="store_true", help="Log the details of every probe and lookup.")
     args = parser.parse_args()
 
-    print("Starting validator check...")
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(levelname)s: %(message)s')
+
+    log.info("Starting validator check...")
     
-    # Load necessary data by running CLI commands
+    # Read the IP list first so a bad path fails before the slow CLI commands start
     if args.ip_list:
         with open(args.ip_list, 'r') as f:
             ip_addresses = [line.strip() for line in f if line.strip()]
-    else:
-        ip_addresses = get_ips_from_rt()
-    active_validator_identities = load_active_validators()
-    validator_info = load_validator_details()
-    gossip_data = load_gossip_data()
+
+    # Load necessary data by running CLI commands. The commands are independent
+    # and mostly wait on external processes, so run them concurrently.
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        ip_future = None if args.ip_list else pool.submit(get_ips_from_rt)
+        validators_future = pool.submit(load_active_validators, args.refresh)
+        validator_info_future = pool.submit(load_validator_details, args.refresh)
+        gossip_future = pool.submit(load_gossip_data, args.refresh)
+
+        if ip_future is not None:
+            ip_addresses = ip_future.result()
+        active_validator_identities = validators_future.result()
+        validator_info = validator_info_future.result()
+        gossip_data = gossip_future.result()
     if not ip_addresses:
-        print("No IP addresses to process. Exiting.")
+        log.info("No IP addresses to process. Exiting.")
         return
         
     if not active_validator_identities:
-        print("Warning: No active validators loaded. IPs cannot be confirmed as validators.")
+        log.warning("No active validators loaded. IPs cannot be confirmed as validators.")
         return
 
     if not validator_info:
-        print("Warning: No validator details loaded. IPs cannot be confirmed as validators.")
+        log.warning("No validator details loaded. IPs cannot be confirmed as validators.")
         return
     
     if not gossip_data:
-        print("Warning: No gossip data loaded. IPs cannot be confirmed as validators.")
+        log.warning("No gossip data loaded. IPs cannot be confirmed as validators.")
         return
-    results = []
-    
-    # Process each IP address
-    for ip in ip_addresses:
-        print(f"\n--- Checking IP: {ip} ---")
-        
-        latency = ping_ip(ip)
-        identity_key = get_identity_from_gossip(ip, gossip_data)
-        
-        status = 'gossip_not_found'
-        name = ''
-
-        if identity_key:
-            # Check if the found identity is in the set of active validators
-            if identity_key in active_validator_identities:
-                status = 'validator'
-                # Look up the validator name from the details map
-                name = validator_info.get(identity_key, "Unknown")                
-                print(f"SUCCESS: IP {ip} with identity {identity_key} is an active validator named '{name}'.")
-            else:
-                status = 'gossip'
-                print(f"INFO: IP {ip} has an identity ({identity_key}) but is NOT in the active validator list.")
-        
-        if args.no_geo:
-            results.append([ip, status, name, latency])
-        else:
-            city, country = get_ip_location(ip)
-            results.append([ip, status, name.replace(',', ''), latency, city, country])
 
-    # Save the results to a CSV file
+    # Index gossip entries by IP once so each lookup is a single dict access
+    gossip_by_ip = {}
+    for entry in gossip_data:
+        ip_address = entry.get("ipAddress")
+        identity_pubkey = entry.get("identityPubkey")
+        if ip_address and identity_pubkey:
+            gossip_by_ip.setdefault(ip_address, identity_pubkey)
+
+    # Duplicate routes would otherwise be probed and reported more than once
+    ip_addresses = list(dict.fromkeys(ip_addresses))
+    if args.only_validators:
+        ip_addresses = [ip for ip in ip_addresses if gossip_by_ip.get(ip) in active_validator_identities]
+        log.info("Probing %s IPs that belong to active validators.", len(ip_addresses))
+
+    # Locations almost never change, so only look up IPs missing from the cache
+    geo_cache = {} if args.no_geo else read_cache('geo') or {}
+    known_locations = {}
+    if not args.no_geo and not args.refresh:
+        known_locations = {ip: tuple(geo_cache[ip]) for ip in ip_addresses if ip in geo_cache}
+    uncached_ips = [] if args.no_geo else [ip for ip in ip_addresses if ip not in known_locations]
+    get_status = functools.partial(get_validator_status, gossip_by_ip=gossip_by_ip,
+                                   active_validator_identities=active_validator_identities,
+                                   validator_info=validator_info)
+
+    # Geolocation lookups are I/O-bound, so run them in batches in a
+    # thread pool while the IPs are being probed.
+    geo_pool = ThreadPoolExecutor(max_workers=GEO_WORKERS)
+    pending_geo = set()
+
+    # Save the results to a CSV file, writing each row as soon as it is complete
+    # so partial results survive an interrupted run.
     try:
         with open(OUTPUT_FILE, 'w', newline='') as f:
-            writer = csv.writer(f)
-            # Write the header
-            if args.no_geo:
-                writer.writerow(['IP', 'Status', 'Validator Name', 'Latency', 'City', 'Country'])
-            else:
-                writer.writerow(['IP', 'Status', 'Validator Name', 'Latency'])
-            # Write the data rows
-            writer.writerows(results)
-        print(f"\nProcess complete. Results saved to '{OUTPUT_FILE}'")
+            results = ResultWriter(f, get_status, need_location=not args.no_geo,
+                                   locations=known_locations)
+
+            def collect_locations(futures):
+                for future in futures:
+                    pending_geo.discard(future)
+                    for ip, (city, country) in future.result().items():
+                        if (city, country) != ('Unknown', 'Unknown'):
+                            geo_cache[ip] = [city, country]
+                        results.add_location(ip, city, country)
+
+            def on_latency(ip, latency, method):
+                collect_locations([future for future in pending_geo if future.done()])
+                results.add_latency(ip, latency, method)
+
+            for start in range(0, len(uncached_ips), GEO_BATCH_SIZE):
+                batch = uncached_ips[start:start + GEO_BATCH_SIZE]
+                pending_geo.add(geo_pool.submit(get_ip_locations, batch))
+
+            measure_latencies(ip_addresses, args.probe, on_latency)
+
+            # Rows still waiting on a location are written as their batches complete
+            collect_locations(as_completed(list(pending_geo)))
+        geo_pool.shutdown()
+        log.info("Process complete. Results saved to '%s'", OUTPUT_FILE)
     except IOError as e:
-        print(f"Error writing to output file '{OUTPUT_FILE}': {e}")
+        log.error("Error writing to output file '%s': %s", OUTPUT_FILE, e)
+    finally:
+        # Drop queued batches and wake any lookup waiting on the rate limit so an
+        # interrupted run does not hang before saving the locations found so far
+        geo_stop.set()
+        geo_pool.shutdown(wait=False, cancel_futures=True)
+        if uncached_ips:
+            write_cache('geo', geo_cache)
 
 if __name__ == "__main__":
     main()